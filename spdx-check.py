@@ -5,6 +5,7 @@
 
 import argparse
 import collections
+import concurrent.futures
 import json
 import os
 import pathlib
@@ -12,6 +13,13 @@ import re
 import subprocess
 import sys
 
+def positive_int(s):
+    value = int(s)
+    if value <= 0:
+        raise argparse.ArgumentTypeError("must be a positive integer, not %s"
+                                         "" % (s))
+    return value
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
     description="""
@@ -49,6 +57,27 @@ parser.add_argument('--copyright-holder', dest='copyright_holder', type=str,
                     commands created by the --reuse-file option,
                     instead of the first author in the git commit log
                     for the file.""")
+parser.add_argument('--submodules', dest='submodules', action='store_true',
+                    help="""Detect git submodules during the traversal,
+                    and scan each one as an independent unit of work,
+                    in parallel, with its own git repository used to
+                    find the history of its files.  The results of all
+                    units are merged into one report.""")
+parser.add_argument('--jobs', dest='jobs', type=positive_int,
+                    help="""The maximum number of units of work that
+                    are scanned in parallel.  Only allowed with the
+                    --submodules option.  Defaults to a value based on
+                    the number of CPUs.""")
+parser.add_argument('--submodule-config-dir', dest='submodule_config_dir',
+                    type=str,
+                    help="""A directory containing optional
+                    configuration files for submodules.  Only allowed
+                    with the --submodules option.  For a submodule in a
+                    directory named NAME, if a file named
+                    spdx-checker-config-NAME.json exists in this
+                    directory, its contents are added to the
+                    configuration used for that submodule.  See
+                    README.md for details.""")
 parser.add_argument('--verbosity', dest='verbosity', type=int, default=0,
                     help="""Verbosity 0 shows no output, only
                     returning a 0 exit status if all files checked
@@ -58,18 +87,29 @@ parser.add_argument('--verbosity', dest='verbosity', type=int, default=0,
                     number of directories and files found of various
                     kinds, and any SPDX license id problems found.""")
 args, remaining_args = parser.parse_known_args()
+if not args.submodules:
+    if args.jobs is not None:
+        parser.error("--jobs is only allowed with --submodules")
+    if args.submodule_config_dir:
+        parser.error("--submodule-config-dir is only allowed with --submodules")
+
+def read_config_file(filename):
+    with open(filename, 'r') as f:
+        contents = f.read()
+    return json.loads(contents)
+
+def normalize_config(config):
+    config['ignored_suffixes'] = set(config.get('ignored_suffixes', []))
+    config['other_licenses'] = config.get('other_licenses', {})
 
 config = {}
 if args.configfile:
-    with open(args.configfile, 'r') as f:
-        contents = f.read()
-    config = json.loads(contents)
+    config = read_config_file(args.configfile)
 else:
     print("Must provide '--config-file <filename>' command line argument.")
     sys.exit(1)
 
-config['ignored_suffixes'] = set(config.get('ignored_suffixes', []))
-config['other_licenses'] = config.get('other_licenses', {})
+normalize_config(config)
 
 if 'default_license' not in config:
     print("top level keys found in config file:")
@@ -88,29 +128,105 @@ def get_current_file_contents(fullname):
         return None, e
     return lines, None
 
-def get_original_file_contents(fullname):
+# A git context is a dict with these keys:
+#
+# 'dir' - the directory in which git commands are run, or None to run
+# them in the current working directory.
+#
+# 'history' - None, or a history index returned by
+# build_history_index() for the repository in 'dir'.  When it is not
+# None, file history is looked up in the index instead of running
+# 'git log' once per file, and file names given to the git helper
+# functions must be relative to 'dir'.
+
+def build_history_index(repo_dir):
+    """Run 'git log' once in the directory repo_dir, and return a dict
+    where each key is a file name relative to repo_dir, and its value
+    is a dict with the SHA, author name, and year of the oldest commit
+    that modified the file, and the number of commits that modified
+    it."""
+    # With --raw and -z, the output is a sequence of NUL terminated
+    # fields.  Each commit starts with one field formatted by --format,
+    # followed by a pair of fields for each file it modified: a raw
+    # diff status starting with ':', and the file name, unquoted.
+    cmd = ['git', 'log', '-z', '--reverse', '--no-renames', '--relative',
+           '--raw', '--no-abbrev', '--date=format:%Y', '--format=%H %ad %aN']
+    history = {}
+    try:
+        completed = subprocess.run(cmd, cwd=repo_dir, capture_output=True,
+                                   encoding='utf-8',
+                                   errors='surrogateescape')
+    except Exception as e:
+        print("dbg repo_dir='%s' build_history_index exception='%s'"
+              "" % (repo_dir, e))
+        return history
+    if completed.returncode != 0:
+        print("git log failed in directory '%s', so no file history is"
+              " available for it: %s"
+              "" % (repo_dir, completed.stderr.strip()))
+        return history
+    sha = None
+    author = None
+    year_str = None
+    fields = completed.stdout.split('\0')
+    i = 0
+    while i < len(fields):
+        field = fields[i]
+        i += 1
+        if field.lstrip('\n').startswith(':'):
+            file_name = fields[i]
+            i += 1
+            if file_name not in history:
+                history[file_name] = {
+                    'oldest_sha': sha,
+                    'author': author,
+                    'year_str': year_str,
+                    'num_commits': 0
+                }
+            history[file_name]['num_commits'] += 1
+        elif field != "":
+            sha, year_str, author = field.split(' ', 2)
+    return history
+
+def new_git_context(repo_dir):
+    return {'dir': repo_dir, 'history': build_history_index(repo_dir)}
+
+def get_original_file_contents(fullname, git_context):
     verbosity = args.verbosity
     if fullname.endswith('status.proto'):
         verbosity = 3
-    # Get all commit SHAs, and keep oldest one, output first
-    cmd1 = ['git', 'log', '--reverse', '--format=%H', '--', fullname]
-    try:
-        completed = subprocess.run(cmd1, capture_output=True,
-                                   encoding='utf-8')
-        lines = completed.stdout.splitlines()
-        if len(lines) == 0:
-            if verbosity >= 1:
-                print("dbg get_original fullname='%s' no commit shas"
-                      "" % (fullname))
-        oldest_sha = completed.stdout.splitlines()[0]
-#        if verbosity >= 3:
-#            print("dbg get_original fullname='%s' oldest_sha='%s' completed.stdout.splitlines()=%s"
-#                  % (fullname, oldest_sha, completed.stdout.splitlines()))
-    except Exception as e:
-        return None, e
-    cmd2 = ['git', 'show', oldest_sha + ':' + fullname]
+    history = git_context['history']
+    if history is not None and fullname in history:
+        oldest_sha = history[fullname]['oldest_sha']
+    else:
+        # Files not in the history index, e.g. those first added in a
+        # merge commit, are looked up with their own 'git log'.
+        # Get all commit SHAs, and keep oldest one, output first
+        cmd1 = ['git', 'log', '--reverse', '--format=%H', '--', fullname]
+        try:
+            completed = subprocess.run(cmd1, cwd=git_context['dir'],
+                                       capture_output=True,
+                                       encoding='utf-8')
+            lines = completed.stdout.splitlines()
+            if len(lines) == 0:
+                if verbosity >= 1:
+                    print("dbg get_original fullname='%s' no commit shas"
+                          "" % (fullname))
+            oldest_sha = completed.stdout.splitlines()[0]
+#            if verbosity >= 3:
+#                print("dbg get_original fullname='%s' oldest_sha='%s' completed.stdout.splitlines()=%s"
+#                      % (fullname, oldest_sha, completed.stdout.splitlines()))
+        except Exception as e:
+            return None, e
+    show_name = fullname
+    if git_context['dir'] is not None:
+        # The file name is relative to the git context directory, not
+        # to the top of the repository.
+        show_name = './' + fullname
+    cmd2 = ['git', 'show', oldest_sha + ':' + show_name]
     try:
-        completed = subprocess.run(cmd2, capture_output=True,
+        completed = subprocess.run(cmd2, cwd=git_context['dir'],
+                                   capture_output=True,
                                    encoding='utf-8')
         lines = completed.stdout.splitlines()
         if verbosity >= 3:
@@ -266,11 +382,16 @@ def spdx_line_errors_warnings(lines, expected_license, config, verbose=False):
 # committed, via 'git log <filename>', and finding the last
 # (i.e. oldest) commit, which should be the one that added the file.
 
-def get_file_first_commit_info(fullname):
+def get_file_first_commit_info(fullname, git_context):
+    history = git_context['history']
+    if history is not None and fullname in history:
+        info = history[fullname]
+        return False, info['num_commits'], info['author'], info['year_str']
     cmd = ['git', 'log', fullname]
     got_exception = False
     try:
-        completed = subprocess.run(cmd, capture_output=True,
+        completed = subprocess.run(cmd, cwd=git_context['dir'],
+                                   capture_output=True,
                                    encoding='utf-8')
         prev_line_was_author = False
         num_commits = 0
@@ -304,8 +425,48 @@ def get_file_first_commit_info(fullname):
     return got_exception, num_commits, author, year_str
 
 
-def walk_directory(path, config):
-    exit_status = 0
+def directory_is_ignored(root, dir_without_rootdir, ignore_directories,
+                         ignore_paths):
+    # A string in the list ignore_directories is one where if it
+    # is any part of the directory part of a path name, the
+    # directory is skipped.  For example if you put "third-party"
+    # into the list of ignore_directories, then all of these paths
+    # would be skipped:
+    #
+    #     ./other/target-syslibs/third-party
+    #     ./other/target-utils/third-party
+    #     ./other/open-p4studio/pkgsrc/bf-diags/third-party
+    #     ./other/open-p4studio/pkgsrc/bf-utils/third-party
+    #     ./other/open-p4studio/pkgsrc/bf-drivers/third-party
+    for dir in ignore_directories:
+        if root.endswith('/' + dir) or (('/' + dir + '/') in root):
+            return True
+    # A string in the list ignore_paths is one where it is only
+    # skipped if it matches the _beginning_ of a relative path
+    # name in the walk.  For example, if ignore_paths contains the
+    # string ".github", then these directories would be skipped:
+    #
+    #     .github
+    #     .github/workflows
+    #
+    # but this one would not be skipped:
+    #
+    #     workflows/.github
+    for tmp_path in ignore_paths:
+        if dir_without_rootdir.startswith(tmp_path):
+            return True
+    return False
+
+
+def scan_directory(path, config, git_context, find_submodules=False):
+    """Check all files in the directory path and its subdirectories,
+    and return a dict of the results, to be printed by report_results().
+
+    If find_submodules is True, subdirectories that are the top of
+    another git repository, e.g. a git submodule, are not scanned.
+    Instead they are returned in the list 'submodule_directories' of
+    the results, as tuples (full directory name, directory name
+    relative to path)."""
     all_non_link_files = {}
     spdx_errors = {}
     spdx_errors_filename_suffixes = collections.defaultdict(int)
@@ -324,50 +485,43 @@ def walk_directory(path, config):
     ignore_files = config.get('ignore_files', {})
     all_directories = []
     skipped_directories = []
+    submodule_directories = []
     copyright_info = {}
     orig_copyright_info = {}
+    first_commit_info = {}
     for root, dirs, files in os.walk(path):
         all_directories.append(root)
         dir_without_rootdir = root[len(path)+1:]
         #print("dbg path='%s' (len %d) root='%s' dir_without_rootdir='%s'"
         #      "" % (path, len(path), root, dir_without_rootdir))
-        skip_dir = False
-        # A string in the list ignore_directories is one where if it
-        # is any part of the directory part of a path name, the
-        # directory is skipped.  For example if you put "third-party"
-        # into the list of ignore_directories, then all of these paths
-        # would be skipped:
-        #
-        #     ./other/target-syslibs/third-party
-        #     ./other/target-utils/third-party
-        #     ./other/open-p4studio/pkgsrc/bf-diags/third-party
-        #     ./other/open-p4studio/pkgsrc/bf-utils/third-party
-        #     ./other/open-p4studio/pkgsrc/bf-drivers/third-party
-        for dir in ignore_directories:
-            if root.endswith('/' + dir) or (('/' + dir + '/') in root):
-                skip_dir = True
-                break
-        # A string in the list ignore_paths is one where it is only
-        # skipped if it matches the _beginning_ of a relative path
-        # name in the walk.  For example, if ignore_paths contains the
-        # string ".github", then these directories would be skipped:
-        #
-        #     .github
-        #     .github/workflows
-        #
-        # but this one would not be skipped:
-        #
-        #     workflows/.github
-        if not skip_dir:
-            for tmp_path in ignore_paths:
-                if dir_without_rootdir.startswith(tmp_path):
-                    skip_dir = True
-                    break
-        if skip_dir:
+        if directory_is_ignored(root, dir_without_rootdir,
+                                ignore_directories, ignore_paths):
             if args.verbosity >= 4:
                 print("Skipping directory: %s" % (root))
             skipped_directories.append(root)
             continue
+        if find_submodules:
+            # A git submodule has a file named .git in its top
+            # directory, and a nested clone has a directory named .git.
+            # Remove them from dirs so that os.walk does not descend
+            # into them.  Those that would be skipped anyway are left
+            # for the check above.
+            for dir in list(dirs):
+                subdir_fullname = os.path.join(root, dir)
+                subdir = os.path.join(dir_without_rootdir, dir)
+                if os.path.islink(subdir_fullname):
+                    # os.walk does not follow symbolic links to
+                    # directories, so neither do we.
+                    continue
+                if not os.path.lexists(os.path.join(subdir_fullname, '.git')):
+                    continue
+                if directory_is_ignored(subdir_fullname, subdir,
+                                        ignore_directories, ignore_paths):
+                    continue
+                if args.verbosity >= 4:
+                    print("Found submodule directory: %s" % (subdir_fullname))
+                dirs.remove(dir)
+                submodule_directories.append((subdir_fullname, subdir))
         if args.verbosity >= 4:
             print("Checking directory: %s (without rootdir %s)" % (root, dir_without_rootdir))
         for file_name in files:
@@ -382,6 +536,10 @@ def walk_directory(path, config):
                 # scan.
                 symbolic_links[fullname] = True
                 continue
+            if find_submodules and dir_without_rootdir == "" and file_name == '.git':
+                # The .git file at the top of a submodule only records
+                # where its git repository is stored.
+                continue
             all_non_link_files[fullname] = {}
             fullname_without_rootdir = os.path.join(dir_without_rootdir,
                                                     file_name)
@@ -410,7 +568,7 @@ def walk_directory(path, config):
                 lines = ["foo"]
             # Read contents of file when it was first added to the repo
             # Note: This requires the relative path name, not fullname.
-            orig_lines, exception = get_original_file_contents(relativetorootname)
+            orig_lines, exception = get_original_file_contents(relativetorootname, git_context)
             if exception is not None:
                 print("dbg fullname='%s' file_name='%s' get_original_file_contents exception='%s'" % (fullname, file_name, exception))
                 exception_reading[fullname] = exception
@@ -441,6 +599,13 @@ def walk_directory(path, config):
                     key = "(none)"
                     filenames_without_suffix.append(fullname)
                 spdx_errors_filename_suffixes[key] += 1
+                if args.addlicense_file or args.reuse_file:
+                    # With a history index, file names are looked up
+                    # relative to the git context directory.
+                    git_name = fullname
+                    if git_context['history'] is not None:
+                        git_name = relativetorootname
+                    first_commit_info[fullname] = get_file_first_commit_info(git_name, git_context)
             if warnings:
                 spdx_warnings[fullname] = warnings
             if all_lines_blank:
@@ -456,7 +621,64 @@ def walk_directory(path, config):
                         'expected': expected_license,
                         'found': license
                     }
+    return {
+        'all_non_link_files': all_non_link_files,
+        'spdx_errors': spdx_errors,
+        'spdx_errors_filename_suffixes': spdx_errors_filename_suffixes,
+        'filenames_without_suffix': filenames_without_suffix,
+        'spdx_warnings': spdx_warnings,
+        'auto_generated_file': auto_generated_file,
+        'symbolic_links': symbolic_links,
+        'empty_file': empty_file,
+        'spdx_unexpected_license': spdx_unexpected_license,
+        'spdx_good': spdx_good,
+        'spdx_good_count_by_license': spdx_good_count_by_license,
+        'spdx_ignored_suffix': spdx_ignored_suffix,
+        'exception_reading': exception_reading,
+        'all_directories': all_directories,
+        'skipped_directories': skipped_directories,
+        'submodule_directories': submodule_directories,
+        'copyright_info': copyright_info,
+        'orig_copyright_info': orig_copyright_info,
+        'first_commit_info': first_commit_info
+    }
+
+
+def merge_scan_results(results, unit_results):
+    """Merge the results of scan_directory() for one unit of work into
+    the dict results."""
+    for key, value in unit_results.items():
+        if key not in results:
+            results[key] = value
+        elif isinstance(value, list):
+            results[key].extend(value)
+        elif isinstance(value, collections.defaultdict):
+            for k in value:
+                results[key][k] += value[k]
+        else:
+            results[key].update(value)
+
 
+def report_results(results):
+    exit_status = 0
+    spdx_errors = results['spdx_errors']
+    spdx_errors_filename_suffixes = results['spdx_errors_filename_suffixes']
+    filenames_without_suffix = results['filenames_without_suffix']
+    spdx_warnings = results['spdx_warnings']
+    auto_generated_file = results['auto_generated_file']
+    symbolic_links = results['symbolic_links']
+    empty_file = results['empty_file']
+    spdx_unexpected_license = results['spdx_unexpected_license']
+    spdx_good = results['spdx_good']
+    spdx_good_count_by_license = results['spdx_good_count_by_license']
+    spdx_ignored_suffix = results['spdx_ignored_suffix']
+    exception_reading = results['exception_reading']
+    all_directories = results['all_directories']
+    skipped_directories = results['skipped_directories']
+    submodule_directories = results['submodule_directories']
+    copyright_info = results['copyright_info']
+    orig_copyright_info = results['orig_copyright_info']
+    first_commit_info = results['first_commit_info']
     for fullname in sorted(exception_reading.keys()):
         print("EXCEPTION: while reading file '%s': %s"
               "" % (fullname, exception_reading[fullname]))
@@ -485,9 +707,12 @@ def walk_directory(path, config):
         print("%d files where exception occurred while reading its contents" % (len(exception_reading)))
         print("%d directories skipped out of %d directories total"
               "" % (len(skipped_directories), len(all_directories)))
+        if args.submodules:
+            print("%d submodule directories scanned as separate units"
+                  "" % (len(submodule_directories)))
         print("%d files where SPDX check was skipped because of file name suffix" % (len(spdx_ignored_suffix)))
     if args.verbosity >= 3:
-        for fname in filenames_without_suffix:
+        for fname in sorted(filenames_without_suffix):
             print("    NOTE file without suffix: %s" % (fname))
     if args.verbosity >= 1:
         print("%d files with signature lines indicating they were auto-generated."
@@ -516,7 +741,7 @@ def walk_directory(path, config):
         num_reuse_cmds = 0
         for fullname in sorted(spdx_errors.keys()):
         #for fullname in sorted(all_non_link_files.keys()):
-            got_exception, num_commits, author, year_str = get_file_first_commit_info(fullname)
+            got_exception, num_commits, author, year_str = first_commit_info[fullname]
             # Order of priority of choosing a copyright holder and year for the command:
             # (1) user-specified value by --copyright-holder command line option
             # (2) copyright holder in first Copyright line in first version of the file
@@ -576,7 +801,7 @@ def walk_directory(path, config):
                     reuse_script_lines.append(msg)
                     num_reuse_cmds += 1
         if args.addlicense_file:
-            with open(args.addlicense_file, 'w') as f:
+            with open(args.addlicense_file, 'w', errors='surrogateescape') as f:
                 print("#! /bin/bash", file=f)
                 print("", file=f)
                 for line in addlicense_script_lines:
@@ -585,7 +810,7 @@ def walk_directory(path, config):
                 print("Wrote bash script with %d addlicense commands: %s"
                       "" % (num_addlicense_cmds, args.addlicense_file))
         if args.reuse_file:
-            with open(args.reuse_file, 'w') as f:
+            with open(args.reuse_file, 'w', errors='surrogateescape') as f:
                 print("#! /bin/bash", file=f)
                 print("", file=f)
                 for line in reuse_script_lines:
@@ -654,11 +879,95 @@ def walk_directory(path, config):
     return exit_status
 
 
+def walk_directory(path, config):
+    git_context = {'dir': None, 'history': None}
+    results = scan_directory(path, config, git_context)
+    return report_results(results)
+
+
+def merge_config_overlay(config, overlay):
+    """Add the contents of the configuration overlay to config.  List
+    values are added to the list in config, dict values are added to
+    the dict in config, with those in overlay taking precedence for
+    the same key, and all other values replace the one in config."""
+    for key, value in overlay.items():
+        base = config.get(key)
+        if isinstance(value, list) and isinstance(base, set):
+            config[key] = base | set(value)
+        elif isinstance(value, list) and isinstance(base, list):
+            config[key] = base + [v for v in value if v not in base]
+        elif isinstance(value, dict) and isinstance(base, dict):
+            merged = dict(base)
+            merged.update(value)
+            config[key] = merged
+        else:
+            config[key] = value
+
+
+def submodule_config(config, subdir):
+    """Return the configuration to use for a submodule in the directory
+    subdir, given relative to the root of the scan that found it, and
+    config, the configuration used for that scan."""
+    # Keys of config that contain path names relative to the root of
+    # the scan are changed to be relative to the submodule directory.
+    # Those outside of the submodule do not apply to it.
+    prefix = subdir + '/'
+    sub_config = dict(config)
+    sub_config['ignore_paths'] = [p[len(prefix):]
+                                  for p in config.get('ignore_paths', [])
+                                  if p.startswith(prefix)]
+    for key in ['ignore_files', 'other_licenses']:
+        sub_config[key] = {k[len(prefix):]: v
+                           for k, v in config.get(key, {}).items()
+                           if k.startswith(prefix)}
+    if args.submodule_config_dir:
+        overlay_file = os.path.join(args.submodule_config_dir,
+                                    "spdx-checker-config-%s.json"
+                                    "" % (os.path.basename(subdir)))
+        if os.path.isfile(overlay_file):
+            if args.verbosity >= 1:
+                print("Using config file %s for submodule %s"
+                      "" % (overlay_file, subdir))
+            merge_config_overlay(sub_config, read_config_file(overlay_file))
+            normalize_config(sub_config)
+    return sub_config
+
+
+def scan_unit(path, config):
+    git_context = new_git_context(path)
+    return scan_directory(path, config, git_context, find_submodules=True)
+
+
+def walk_directory_submodules(path, config, jobs):
+    """Scan the directory path, and every git submodule found inside
+    of it, as independent units of work in parallel, and print one
+    report of the merged results."""
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(scan_unit, path, config): config}
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                unit_config = pending.pop(future)
+                unit_results = future.result()
+                for subdir_fullname, subdir in unit_results['submodule_directories']:
+                    sub_config = submodule_config(unit_config, subdir)
+                    future = executor.submit(scan_unit, subdir_fullname,
+                                             sub_config)
+                    pending[future] = sub_config
+                merge_scan_results(results, unit_results)
+    return report_results(results)
+
+
 rootdir = "."
 if args.rootdir:
     rootdir = args.rootdir
 
-exit_status = walk_directory(rootdir, config)
+if args.submodules:
+    exit_status = walk_directory_submodules(rootdir, config, args.jobs)
+else:
+    exit_status = walk_directory(rootdir, config)
 #if args.verbosity >= 1:
 #    print("dbg exit_status=%d" % (exit_status))
 sys.exit(exit_status)